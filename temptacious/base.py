@@ -32,17 +32,11 @@
         boom * rendered template
 '''
 
-import re
-import string # for whitespace
-
-
-# debugging
 import sys
-import warnings
+import string # for whitespace
+import functools
+import pprint # for the *stat* debug helper
 from enum import Enum, auto
-from pprint import pprint
-
-stop = sys.exit
 
 
 class TemplateError(Exception):
@@ -64,39 +58,26 @@ VARIABLE_TAG_END = '}}'
 
 
 
-# match any of the node_types
-placeholder_re =re.compile("(\{\%.*?\%\}"  # try to match a block {% for ...%}
-                    '|\{\{.*?\}\}'	# then match a variable {{ var }}
-                    '|\{\#.*?\#\})'	# then match a comment {# comment #}
-                    )
-
-tell_line = lambda token: "at {} line".format(_get_pos(token.lineno))
-
-def _split(str_):
-    # split a str by an empty string
-    return [i for i in str_]
+tell_line = lambda token: f"at {_get_pos(token.lineno)} line"
 
+# chars stripped off an expression, built once instead of per Expression
+_EXPR_STRIP = string.whitespace + '.'
 
 def _get_pos(num):
-    s = str(num)
-    d = {'1': 'st', '2': 'nd', '3': 'rd'}
-    for i in range(4, 21):
-        if s.endswith(str(i)):
-            return s+'th'
-    for i in d:
-        if s.endswith(str(i)):
-            return s+d[i]
-    return 'th'
+    # 1st, 2nd, 3rd, ... pure arithmetic, no string scans
+    if 10 <= num % 100 <= 20:
+        suffix = 'th'
+    else:
+        suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(num % 10, 'th')
+    return '%d%s' % (num, suffix)
 
 
 def stat(tokens, filter=None):
-    import pprint as p
-    result = []
     filter = filter.upper() if filter else ''
     if filter and filter in ('TEXT', 'VAR', 'BLOCK', 'COMMENT'):
-        p.pprint([(token.token_type.name, token.contents) for token in tokens if token.token_type.name == filter])
+        pprint.pprint([(token.token_type.name, token.contents) for token in tokens if token.token_type.name == filter])
     else:
-        p.pprint([(token.token_type.name, token.contents) for token in tokens])
+        pprint.pprint([(token.token_type.name, token.contents) for token in tokens])
 
 
 class Expression:
@@ -114,22 +95,24 @@ class Expression:
         else: # token is a string
             expression = str(token)
             self.token = None
-        self.expression = str(expression).strip(string.whitespace + '.')
-    
+        self.expression = str(expression).strip(_EXPR_STRIP)
+        # split the dotted path once here, resolve() runs per render
+        parts = self.expression.split('.')
+        self._first = parts[0]
+        self._attrs = tuple(parts[1:])
+
     def resolve(self, context):
-        exp = self.expression.split('.')
         try:
-            first = exp.pop(0)
-            value = context[first]
-            for indx, variable in enumerate(exp):
-                try:
-                    attrib = getattr(value, variable)
-                except AttributeError:
-                    self.error('AttributeError: <%s> has not attribute named <%s>'%(variable, value))
-                if callable(attrib):
-                    value = attrib() # catch TypeError for insufficient arguments
+            value = context[self._first]
         except KeyError as ex:
             self.error('NameError: "%s" does not exists in context', ex)
+        for variable in self._attrs:
+            try:
+                value = getattr(value, variable)
+            except AttributeError:
+                self.error('AttributeError: <%s> has not attribute named <%s>'%(variable, value))
+            if callable(value):
+                value = value() # catch TypeError for insufficient arguments
         return value
     
     def error(self, e, former_stack=None):
@@ -172,61 +155,112 @@ class Token:
         return "<Token type:'%s' lineno:'%s' at %s>"%(self.token_type.name.lower(), _get_pos(self.lineno), str(hex(id(self))))
 
 
+# map the character after '{' to the token type and closing delimiter
+_TAG_TYPES = {
+    '%': (TokenType.BLOCK, BLOCK_TAG_END),
+    '{': (TokenType.VAR, VARIABLE_TAG_END),
+    '#': (TokenType.COMMENT, COMMENT_TAG_END),
+}
+
+# bytes-domain twin of _TAG_TYPES, indexing bytes yields ints
+_TAG_TYPES_BYTES = {
+    ord('%'): (TokenType.BLOCK, b'%}'),
+    ord('{'): (TokenType.VAR, b'}}'),
+    ord('#'): (TokenType.COMMENT, b'#}'),
+}
+
+
 class Tokeniser:
     '''Creates tokens from *template_string*.'''
     # Note for now tokens that do not start and end with thier delimiter
-    # are ignored
+    # are treated as plain text
     def __init__(self, template_string):
         self.template_string = template_string
         self.debug = True
 
     def tokenise(self):
-        '''Gather all tokens an return it.'''
-        unparsed_tokens = self.split()
-        
+        '''Gather all tokens an return it.
+
+        A single pass over the template string, str.find does the bulk
+        jumping between tags so no regex is needed.
+        '''
+        s = self.template_string
+        if isinstance(s, bytes):
+            return self._tokenise_bytes(s)
+        length = len(s)
         tokens = []
         lineno = 1
-        for bit in unparsed_tokens:
-            if bit:
-                token = self.get_token(bit, lineno)
-                tokens.append(token)
-            lineno += bit.count('\n')
-            
-        # if self.debug:
-        #     'self.gather_tokens()'
-        #     # print('done serving tokens from Tokeniser')
-        #     # stat(tokens)
+        last_nl_scan = 0    # newlines before this offset are already counted
+        pos = 0     # start of the text run not emitted yet
+        i = 0       # scan position
+        while True:
+            i = s.find('{', i)
+            if i == -1 or i + 1 >= length:
+                break
+            tag = _TAG_TYPES.get(s[i+1])
+            if tag is None:
+                i += 1
+                continue
+            token_type, end_tag = tag
+            close = s.find(end_tag, i+2)
+            # a tag never spans lines and an unclosed opener is plain text
+            if close == -1 or s.find('\n', i+2, close) != -1:
+                i += 2
+                continue
+            # count newlines by offset so each span is scanned once,
+            # without slicing out text just to count over it
+            if pos < i:
+                lineno += s.count('\n', last_nl_scan, pos)
+                last_nl_scan = pos
+                tokens.append(Token(TokenType.TEXT, s[pos:i], lineno))
+            lineno += s.count('\n', last_nl_scan, i)
+            last_nl_scan = i
+            tokens.append(Token(token_type, s[i+2:close].strip(), lineno))
+            i = pos = close + 2
+        if pos < length:
+            lineno += s.count('\n', last_nl_scan, pos)
+            tokens.append(Token(TokenType.TEXT, s[pos:], lineno))
+        return tokens
+
+    def _tokenise_bytes(self, s):
+        '''Same scan as tokenise() but over bytes.
+
+        Templates read straight from disk stay bytes: bytes.find does the
+        jumping and only the emitted segments are utf-8 decoded, so there
+        is no up-front decode of the whole template.
+        '''
+        length = len(s)
+        tokens = []
+        lineno = 1
+        last_nl_scan = 0    # newlines before this offset are already counted
+        pos = 0     # start of the text run not emitted yet
+        i = 0       # scan position
+        while True:
+            i = s.find(b'{', i)
+            if i == -1 or i + 1 >= length:
+                break
+            tag = _TAG_TYPES_BYTES.get(s[i+1])
+            if tag is None:
+                i += 1
+                continue
+            token_type, end_tag = tag
+            close = s.find(end_tag, i+2)
+            # a tag never spans lines and an unclosed opener is plain text
+            if close == -1 or s.find(b'\n', i+2, close) != -1:
+                i += 2
+                continue
+            if pos < i:
+                lineno += s.count(b'\n', last_nl_scan, pos)
+                last_nl_scan = pos
+                tokens.append(Token(TokenType.TEXT, s[pos:i].decode('utf-8'), lineno))
+            lineno += s.count(b'\n', last_nl_scan, i)
+            last_nl_scan = i
+            tokens.append(Token(token_type, s[i+2:close].strip().decode('utf-8'), lineno))
+            i = pos = close + 2
+        if pos < length:
+            lineno += s.count(b'\n', last_nl_scan, pos)
+            tokens.append(Token(TokenType.TEXT, s[pos:].decode('utf-8'), lineno))
         return tokens
-    
-    def split(self):
-        return placeholder_re.split(self.template_string)
-    
-    def get_token(self, bit, lineno):
-        '''Returns a token using a token string.'''
-        if bit.startswith(VARIABLE_TAG_START):
-            return Token(TokenType.VAR,
-                         self.get_contents(bit, VARIABLE_TAG_END),
-                         lineno)
-        elif bit.startswith(COMMENT_TAG_START):
-            return Token(TokenType.COMMENT,
-                         self.get_contents(bit, COMMENT_TAG_END),
-                         lineno)
-        elif bit.startswith(BLOCK_TAG_START):
-            return Token(TokenType.BLOCK,
-                         self.get_contents(bit, BLOCK_TAG_END),
-                         lineno)
-        else:
-            return Token(TokenType.TEXT, bit, lineno)
-        
-    def get_contents(self, bit, end):
-        if bit.endswith(end):
-            return bit[2:-2].strip()
-        # else:
-        #     parser should do something like
-        #     if '{{' in token.contents:
-        #         raise TemplateError
-        # but for now strange looking tags are ignored
-        return bit
 
 
 ################################################################################
@@ -238,19 +272,39 @@ class Tokeniser:
 
 class TextNode:
     def __init__(self, s):
-        self.s = s
+        # intern small literals so identical chunks repeated across
+        # templates (table rows etc.) share one object
+        self.s = sys.intern(s) if len(s) < 4096 else s
 
     def render(self, context):
         '''text node do not need any more rendering'''
         return self.s
 
+    def render_into(self, context, buf):
+        buf.append(self.s)
+
 
 class VariableNode:
     def __init__(self, expression):
         self.expression = expression
-        
+        self._resolve = expression.resolve # saves an attribute lookup per render
+
     def render(self, context):
-        return str(self.expression.resolve(context))
+        # values are usually str already, skip the redundant str() call
+        value = self._resolve(context)
+        return value if type(value) is str else str(value)
+
+    def render_into(self, context, buf):
+        value = self._resolve(context)
+        buf.append(value if type(value) is str else str(value))
+
+
+# block name -> (endblock name, is_singleton); the parser's hot loop
+# classifies a block token with one dict lookup
+_BLOCK_META = {
+    'for': ('endfor', False),
+    'if': ('endif', False),
+}
 
 
 class BlockHelper:
@@ -296,75 +350,125 @@ class BlockNode: # this class should be private as it's args depend on the progr
     def __init__(self, block_tokens):
         self.block_tokens = block_tokens
         self.blockname = self.get_block_name(self.block_tokens[0])
-        
+        # parse the inner tokens once here, render() only re-walks the nodes
+        if self.blockname == 'for':
+            self.inner_nodes = Parser(self.block_tokens[1:-1]).parse()
+            self._parse_for_head()
+        elif self.blockname == 'if':
+            if_tokens = self.block_tokens[1:-1] # from {%if..%} to {%endif%} not including delimiters
+            else_tokens = []
+            # this will cut out else context if any; only an else at depth
+            # 0 belongs to this if, an else inside a nested block does not
+            depth = 0
+            for indx, token in enumerate(self.block_tokens[1:-1], 1):
+                if token.token_type != TokenType.BLOCK:
+                    continue
+                name = BlockHelper.get_block_name(token)
+                if name == 'else':
+                    if depth == 0:
+                        else_tokens = self.block_tokens[indx+1:-1]
+                        if_tokens = self.block_tokens[1:indx]
+                        break
+                elif name in _BLOCK_META:
+                    depth += 1
+                elif name.startswith('end'):
+                    depth -= 1
+            self.if_nodes = Parser(if_tokens).parse()
+            self.else_nodes = Parser(else_tokens).parse()
+            # build the condition Expression once, resolve() runs per render
+            bits = self.block_tokens[0].contents.split()
+            if len(bits) < 2:
+                raise TemplateError('no condition for if [%s]'%(tell_line(self.block_tokens[0])))
+            self._cond = Expression(bits[1])
+
     def render(self, context):
-        blockname = self.blockname
-        mname = 'do_'+blockname
-        method = getattr(self, mname)
-        return method(context.copy())
+        buf = []
+        self.render_into(context, buf)
+        return ''.join(buf)
+
+    def render_into(self, context, buf):
+        # no context.copy() here, blocks that bind names (do_for) save
+        # and restore them instead of copying the whole dict per render
+        method = getattr(self, 'do_'+self.blockname)
+        method(context, buf)
     
-    def _render(self, nodes, context):
-        return ''.join([str(node.render(context)) for node in nodes])
-    
-    def do_for(self, context):
-        '''for <vars> in <iterable> [reverse]
-        <var> will be introduced into context and will be rendered
-        <vars> :: a, b
-        n number of times depending on <iterable>
-        '''
-        context = context
-        block_head = self.block_tokens[0].contents.strip()
-        # some serious parsing is about to take place
+    def _parse_for_head(self):
+        '''Parse 'for <vars> in <iterable> [reverse]' once at construction.'''
+        startblock = self.block_tokens[0]
+        block_head = startblock.contents.strip()
         statement = block_head[3:] # <for> excluded
         try:
             in_ = statement.index('in')
         except ValueError:
-            raise # appropriate error msg will be displayed 
+            raise TemplateError("for block has no 'in' (%s) [%s]"%(block_head, tell_line(startblock)))
         loop_vars = statement[:in_].strip().split(',')
         iteration = statement[in_+2:].strip().split() # *2* here gets us pass the *in* str
-        # print(loop_vars, iteration)
         if not iteration or not loop_vars[0]:
-            raise
-        reverse = len(iteration) == 2 and iteration[1].lower() == 'reverse'
-        iter = context[iteration[0]]
-        if reverse:
-            iter = reversed(iter)
-        # render
-        res_nodes = []
-        for item in iter:
-            if len(loop_vars) > 1:
+            raise TemplateError("Invalid for block (%s) [%s]"%(block_head, tell_line(startblock)))
+        self._loop_vars = tuple(var.strip() for var in loop_vars)
+        self._iter_name = iteration[0]
+        self._reverse = len(iteration) == 2 and iteration[1].lower() == 'reverse'
+        # the single-var/unpack distinction is loop invariant, pick the
+        # specialised body once instead of branching every iteration
+        self._do_for = self._do_for_multi if len(self._loop_vars) > 1 else self._do_for_single
+
+    def do_for(self, context, buf):
+        '''for <vars> in <iterable> [reverse]
+        <var> will be introduced into context and will be rendered
+        <vars> :: a, b
+        n number of times depending on <iterable>
+        '''
+        self._do_for(context, buf)
+
+    def _do_for_single(self, context, buf):
+        var = self._loop_vars[0]
+        iterable = context[self._iter_name]
+        if self._reverse:
+            iterable = reversed(iterable)
+        missing = var not in context
+        saved = context.get(var)
+        inner_nodes = self.inner_nodes
+        # render straight into the shared buffer, no per-iteration join;
+        # restore in finally so a failed render can't leak the loop var
+        # into the caller's dict
+        try:
+            for item in iterable:
+                context[var] = item
+                for node in inner_nodes:
+                    node.render_into(context, buf)
+        finally:
+            # put the caller's binding back
+            if missing:
+                context.pop(var, None)
+            else:
+                context[var] = saved
+
+    def _do_for_multi(self, context, buf):
+        loop_vars = self._loop_vars
+        iterable = context[self._iter_name]
+        if self._reverse:
+            iterable = reversed(iterable)
+        saved = {var: context[var] for var in loop_vars if var in context}
+        inner_nodes = self.inner_nodes
+        try:
+            for item in iterable:
                 for i, var in enumerate(loop_vars):
                     context[var] = item[i]
-                
-            else:
-                context[loop_vars[0]] = item
-            for_tokens = self.block_tokens[1:-1]
-            inner_nodes = Parser(for_tokens).parse()
-            res_nodes.append(TextNode(self._render(inner_nodes, context)))
-        return self._render(res_nodes, context)
+                for node in inner_nodes:
+                    node.render_into(context, buf)
+        finally:
+            # put the caller's bindings back
+            for var in loop_vars:
+                if var in saved:
+                    context[var] = saved[var]
+                else:
+                    context.pop(var, None)
     
-    def do_if(self, context):
+    def do_if(self, context, buf):
         '''based on codition.'''
-        startblock = self.block_tokens[0]
-        if_context = self.block_tokens[1:-1] # from {%if..%} to {%endif%} not including delimiters
-        else_context = []
-        # this will cut out else context if any
-        for indx, token in enumerate(self.block_tokens):
-            if token.token_type == TokenType.BLOCK and BlockHelper.get_block_name(token) == 'else':
-                else_context.extend(self.block_tokens[indx+1:-1])
-                if_context = self.block_tokens[1:indx]
-        # stat(if_context)
-        # stat(else_context)
-        try:
-            condition = Expression(startblock.contents.split()[1]).resolve(context)
-        except IndexError:
-            raise TemplateError('no condition for if')
-        if condition:
-            context_to_parse = if_context
-        else:
-            context_to_parse = else_context
-        nodes = Parser(context_to_parse).parse()
-        return ''.join([str(node.render(context)) for node in nodes])
+        nodes = self.if_nodes if self._cond.resolve(context) else self.else_nodes
+        for node in nodes:
+            node.render_into(context, buf)
     
     def get_block_name(self, token):
         return BlockHelper.get_block_name(token)
@@ -381,55 +485,81 @@ class Parser:
 
     def parse(self):
         '''Returns a node list.'''
+        # bind the names the loop hits per token to locals, LOAD_FAST
+        # instead of LOAD_GLOBAL + LOAD_ATTR on every iteration
+        TEXT = TokenType.TEXT
+        VAR = TokenType.VAR
+        BLOCK = TokenType.BLOCK
+        COMMENT = TokenType.COMMENT
+        get_meta = _BLOCK_META.get
+        text_node = TextNode
+        variable_node = VariableNode
+        expression = Expression
+
         nodes = []
-        finding_end_block = False   # when this is True find a block named *end_block*
-        block_tokens = []           # from <startblock> to <endblock>
-        end_block = None            # end block to find
-        # a block can contain other blocks, in other not to confuse their <endblock>s
-        # as THE end block any similar child block found will increment *locals* when their 
-        # closing block is found this will decrement
-        # if a closing block is found and this is 0 it is assumed to be the end block for this scope
-        locals = 0  # If an endblock is found and (locals != 0) then it's not found
-        
+        open_name = None    # block whose end tag we are looking for
+        end_block = None
+        block_tokens = []   # from <startblock> to <endblock>
+        # a block can contain other blocks, in other not to confuse their
+        # <endblock>s as THE end block any same-named child block found will
+        # increment *depth*, their closing block will decrement it; a closing
+        # block found at depth 0 closes this scope
+        depth = 0
+
         for token in self.tokens:
-            if not finding_end_block:
-                if token.token_type == TokenType.TEXT:
-                    nodes.append(TextNode(token.contents))
-                elif token.token_type == TokenType.VAR:
+            token_type = token.token_type
+            if open_name is None:
+                if token_type == TEXT:
+                    # fold runs of text (e.g. around dropped comments)
+                    # into one node so render appends once for the run
+                    if nodes and isinstance(nodes[-1], text_node):
+                        nodes[-1].s += token.contents
+                    else:
+                        nodes.append(text_node(token.contents))
+                elif token_type == VAR:
                     if not token.contents:
                         raise TemplateError('Empty variable cannot substitute')
                     else:
-                        nodes.append(VariableNode(Expression(token)))
-                elif token.token_type == TokenType.COMMENT:
+                        nodes.append(variable_node(expression(token)))
+                elif token_type == COMMENT:
                     pass # roses a blue comments are gone and so is yours :)
-                elif token.token_type == TokenType.BLOCK:
-                    blockinfo = BlockHelper(token)
-                    if blockinfo.is_singleton:
+                elif token_type == BLOCK:
+                    bits = token.contents.split(None, 1)
+                    if not bits:
+                        raise TemplateError('Empty block %s'%(token.contents))
+                    name = bits[0]
+                    meta = get_meta(name)
+                    if meta is None:
+                        raise TemplateError("Invalid block: the block '%s' is not supported [%s]"%(name, tell_line(token)))
+                    endblock_name, is_singleton = meta
+                    if is_singleton:
                         pass
                     else:
-                        finding_end_block = True
-                        block_tokens.clear()
-                        block_tokens.append(token)
-                        end_block = blockinfo.endblock
-                    
+                        open_name = name
+                        end_block = endblock_name
+                        block_tokens = [token]
+
             else:
-                if token.token_type == TokenType.BLOCK:
-                    block_name = BlockHelper.get_block_name(token)
-                    if block_name == blockinfo.block_name:
-                        locals += 1
-                    elif block_name == end_block:
-                        if locals == 0:
-                            block_tokens.append(token) # need to append else block from here
-                            nodes.append(BlockNode(block_tokens[:])) # or it won't get into the BlockNode
-                            finding_end_block = False
+                if token_type == BLOCK:
+                    bits = token.contents.split(None, 1)
+                    if not bits:
+                        raise TemplateError('Empty block %s'%(token.contents))
+                    name = bits[0]
+                    if name == open_name:
+                        depth += 1
+                    elif name == end_block:
+                        if depth == 0:
+                            block_tokens.append(token) # need to append end block from here
+                            nodes.append(BlockNode(block_tokens)) # or it won't get into the BlockNode
+                            open_name = None
                             end_block = None
                             continue
                         else:
-                            locals -= 1
+                            depth -= 1
                 block_tokens.append(token) # note token not parsed
-        
+
         # finished parsing check for unfinished tags
-        if finding_end_block:
+        if open_name is not None:
             startblock = block_tokens[0]
             raise TemplateError("Could not find endblock for (%s) [%s]"%(startblock.contents,
                                                                           tell_line(startblock)))
@@ -439,19 +569,186 @@ class Parser:
 
 class Template:
     """The template is all you need from this library call render() to render with a context"""
-    
+
+    @classmethod
+    def get(cls, template_string):
+        '''Return a compiled Template for *template_string*.
+
+        Instances carry no per-render state, so identical template text
+        (e.g. built inside a request handler) can share one compiled
+        Template instead of re-parsing every time.
+        '''
+        if not isinstance(template_string, (str, bytes)):
+            template_string = str(template_string)
+        return _get_template(template_string)
+
     def __init__(self, template_string):
-        self.template_string = str(template_string)
-        
+        # bytes pass through untouched, the tokeniser scans them in the
+        # bytes domain and decodes per segment
+        if not isinstance(template_string, (str, bytes)):
+            template_string = str(template_string)
+        self.template_string = template_string
+        # tokenise and parse once up front, render() only walks the nodes
+        self.nodes = Parser(Tokeniser(self.template_string).tokenise()).parse()
+        self._format_string = self._compile_format()
+        self._render_func = self._compile()
+
     def render(self, context):
         '''render the *template_string*.
-        similar to 
-        ''.join([str(node.render(context)) for node in Parser(Tokeniser(template_string).tokenise()).parse()])
+        similar to
+        ''.join([str(node.render(context)) for node in nodes])
         '''
-        tokens = Tokeniser(self.template_string).tokenise()
-        parser = Parser(tokens)
-        nodes = parser.parse()
-        return ''.join([node.render(context) for node in nodes])
+        if self._format_string is not None:
+            try:
+                return self._format_string.format_map(context)
+            except KeyError:
+                pass # fall through so the miss raises the usual ExpressionError
+        if self._render_func is not None:
+            return self._render_func(context)
+        # fallback path: every node appends into one shared buffer so
+        # there is a single join per render, not one per nested block
+        buf = []
+        for node in self.nodes:
+            node.render_into(context, buf)
+        return ''.join(buf)
+
+    def _compile_format(self):
+        '''Specialise fixed-shape templates into one str.format_map call.
+
+        Templates that are only text plus simple {{ var }} substitutions
+        need no control flow at all, so the whole render can run inside
+        CPython's C-level formatter. Returns the format string, or None
+        when the template has blocks or dotted expressions.
+        '''
+        bits = []
+        for node in self.nodes:
+            if isinstance(node, TextNode):
+                bits.append(node.s.replace('{', '{{').replace('}', '}}'))
+            elif isinstance(node, VariableNode):
+                expression = node.expression
+                if expression._attrs or not expression._first.isidentifier():
+                    return None
+                bits.append('{%s!s}' % expression._first)
+            else:
+                return None
+        return ''.join(bits)
+
+    def _compile(self):
+        '''Compile the node list into one generated python function.
+
+        Walking the node tree costs an attribute dispatch per node per
+        render; the generated function is straight-line appends into one
+        buffer. Returns None when some construct cannot be compiled, in
+        which case render() falls back to walking the nodes.
+        '''
+        lines = []
+        namespace = {}
+        counter = [0]
+
+        def new_name(prefix):
+            counter[0] += 1
+            return '_%s%d' % (prefix, counter[0])
+
+        def emit_var(expression, indent):
+            # inline the resolve fast path, fall back to the Expression
+            # object so error messages stay the same
+            pad = '    ' * indent
+            v = new_name('v')
+            e = new_name('e')
+            namespace[e] = expression
+            lines.append(pad + 'try:')
+            lines.append(pad + '    %s = ctx[%r]' % (v, expression._first))
+            for attr in expression._attrs:
+                lines.append(pad + '    %s = getattr(%s, %r)' % (v, v, attr))
+                lines.append(pad + '    if callable(%s): %s = %s()' % (v, v, v))
+            lines.append(pad + 'except (KeyError, AttributeError):')
+            lines.append(pad + '    %s = %s.resolve(ctx)' % (v, e))
+            lines.append(pad + '_append(%s if type(%s) is str else str(%s))' % (v, v, v))
+
+        def emit_for(node, indent):
+            # the loop head is already parsed by BlockNode._parse_for_head
+            pad = '    ' * indent
+            it = new_name('it')
+            item = new_name('item')
+            loop_vars = node._loop_vars
+            # save the caller's bindings so nodes after the loop in the
+            # same render don't see the leaked last item (mirrors the
+            # save/restore do_for does on the interpreted path)
+            saves = [(var, new_name('missing'), new_name('saved')) for var in loop_vars]
+            for var, missing, saved in saves:
+                lines.append(pad + '%s = %r not in ctx' % (missing, var))
+                lines.append(pad + '%s = ctx.get(%r)' % (saved, var))
+            lines.append(pad + '%s = ctx[%r]' % (it, node._iter_name))
+            if node._reverse:
+                lines.append(pad + '%s = reversed(%s)' % (it, it))
+            lines.append(pad + 'for %s in %s:' % (item, it))
+            body_pad = pad + '    '
+            if len(loop_vars) > 1:
+                for i, var in enumerate(loop_vars):
+                    lines.append(body_pad + 'ctx[%r] = %s[%d]' % (var, item, i))
+            else:
+                lines.append(body_pad + 'ctx[%r] = %s' % (loop_vars[0], item))
+            if not emit_nodes(node.inner_nodes, indent + 1):
+                return False
+            # put the caller's bindings back
+            for var, missing, saved in saves:
+                lines.append(pad + 'if %s: ctx.pop(%r, None)' % (missing, var))
+                lines.append(pad + 'else: ctx[%r] = %s' % (var, saved))
+            return True
+
+        def emit_if(node, indent):
+            # the condition Expression is prebuilt by BlockNode
+            pad = '    ' * indent
+            e = new_name('e')
+            namespace[e] = node._cond
+            lines.append(pad + 'if %s.resolve(ctx):' % e)
+            if not emit_nodes(node.if_nodes, indent + 1):
+                return False
+            lines.append(pad + 'else:')
+            return emit_nodes(node.else_nodes, indent + 1)
+
+        def emit_nodes(nodes, indent):
+            pad = '    ' * indent
+            if not nodes:
+                lines.append(pad + 'pass')
+                return True
+            for node in nodes:
+                if isinstance(node, TextNode):
+                    lines.append(pad + '_append(%r)' % node.s)
+                elif isinstance(node, VariableNode):
+                    emit_var(node.expression, indent)
+                elif isinstance(node, BlockNode):
+                    if node.blockname == 'for':
+                        if not emit_for(node, indent):
+                            return False
+                    elif node.blockname == 'if':
+                        if not emit_if(node, indent):
+                            return False
+                    else:
+                        return False
+                else:
+                    return False
+            return True
+
+        lines.append('def _render(context):')
+        if any(isinstance(node, BlockNode) for node in self.nodes):
+            # blocks assign loop vars, keep the caller's context clean
+            lines.append('    ctx = dict(context)')
+        else:
+            lines.append('    ctx = context')
+        lines.append('    buf = []')
+        lines.append('    _append = buf.append')
+        if not emit_nodes(self.nodes, 1):
+            return None
+        lines.append("    return ''.join(buf)")
+        code = compile('\n'.join(lines), '<template>', 'exec')
+        exec(code, namespace)
+        return namespace['_render']
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_template(template_string):
+    return Template(template_string)
 
 
 